@@ -1,5 +1,23 @@
+from array import array
 from copy import deepcopy
+import argparse
+import csv
+import glob
+import hashlib
+import io
+import itertools
 import json
+import math
+import os
+import re
+import struct
+import sys
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
 
 class Attributes:
     name = 'name'
@@ -8,6 +26,12 @@ class Attributes:
     real_time = 'real_time'
     cpu_time = 'cpu_time'
     time_unit = 'time_unit'
+    run_name = 'run_name'
+    aggregate_name = 'aggregate_name'
+
+class RunTypes:
+    iteration = 'iteration'
+    aggregate = 'aggregate'
 
 class Params:
     elements = 'elements'
@@ -30,21 +54,275 @@ class Dtypes:
     s16 = 's16'
     u16 = 'u16'
 
+class ParamTypes:
+    int = 'int'
+    float = 'float'
+    str = 'str'
+
+# Ordered from narrowest to widest; a param only ever widens along this order
+_param_type_order = [ParamTypes.int, ParamTypes.float, ParamTypes.str]
+
+def _wider_param_type(param_type, other_type):
+    return max(param_type, other_type, key=_param_type_order.index)
+
+def _param_type_of(val):
+    if isinstance(val, int):
+        return ParamTypes.int
+    if isinstance(val, float):
+        return ParamTypes.float
+    return ParamTypes.str
+
+def _param_val_str(val):
+    # Whole numbers that were widened through float keep looking like ints,
+    # whichever path they took to become strings
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    return str(val)
+
+# Only plain numeric literals count as numbers; int() and float() would also
+# accept things like '1_000', ' 16' or 'nan', which are better left as strings
+_int_literal_re = re.compile(r'[-+]?[0-9]+\Z')
+_float_literal_re = re.compile(r'[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\Z')
+# Ints are stored in 64-bit columns
+_int_min = -2 ** 63
+_int_max = 2 ** 63 - 1
+
+def _parse_int(val):
+    if isinstance(val, str):
+        if not _int_literal_re.match(val):
+            raise ValueError('Not an int literal: {!r}'.format(val))
+    val = int(val)
+    if not _int_min <= val <= _int_max:
+        raise ValueError('Int out of 64-bit range: {}'.format(val))
+    return val
+
+def _parse_float(val):
+    if isinstance(val, str) and not _float_literal_re.match(val):
+        raise ValueError('Not a float literal: {!r}'.format(val))
+    return float(val)
+
+_param_converters = {
+    ParamTypes.int: _parse_int,
+    ParamTypes.float: _parse_float,
+    ParamTypes.str: _param_val_str
+}
+_param_typecodes = {
+    ParamTypes.int: 'q',
+    ParamTypes.float: 'd',
+    # Strings are stored as codes into a dictionary of distinct values
+    ParamTypes.str: 'q'
+}
+
+def param_vals_equal(param_type, param_val, filter_val):
+    # Compare in the wider of the param's and the filter's types, so that a
+    # filter of 1 still matches once the param has widened to str
+    convert = _param_converters[_wider_param_type(param_type, _param_type_of(filter_val))]
+    try:
+        return convert(param_val) == convert(filter_val)
+    except ValueError:
+        return False
+
+def infer_param_type(val_str, min_type=ParamTypes.int):
+    for param_type in _param_type_order[_param_type_order.index(min_type):-1]:
+        try:
+            _param_converters[param_type](val_str)
+            return param_type
+        except ValueError:
+            pass
+    return ParamTypes.str
+
+class ParamSchema:
+    # Name, type and ordinal position of each param of a benchmark, inferred
+    # from the first result's name and reused to parse the following ones
+    def __init__(self, name_split):
+        self._benchmark_name = name_split[0]
+        self._param_names = []
+        self._param_types = []
+        for i in range(2, len(name_split)):
+            param_name, val_str = _split_param(name_split[i], i)
+            self._param_names.append(param_name)
+            self._param_types.append(infer_param_type(val_str))
+        self._converters = [_param_converters[param_type]
+                            for param_type in self._param_types]
+
+    @property
+    def benchmark_name(self):
+        return self._benchmark_name
+
+    @property
+    def param_names(self):
+        return deepcopy(self._param_names)
+
+    def param_type(self, param_name):
+        return self._param_types[self._param_names.index(param_name)]
+
+    def position(self, param_name):
+        return self._param_names.index(param_name) + 2
+
+    def widen(self, param_name, param_type):
+        i = self._param_names.index(param_name)
+        self._param_types[i] = _wider_param_type(self._param_types[i], param_type)
+        self._converters[i] = _param_converters[self._param_types[i]]
+
+    def _convert(self, i, val_str):
+        try:
+            return self._converters[i](val_str)
+        except ValueError:
+            self._param_types[i] = infer_param_type(val_str, self._param_types[i])
+            self._converters[i] = _param_converters[self._param_types[i]]
+            return self._converters[i](val_str)
+
+    def parse(self, name_split):
+        # Returns None if the name doesn't have exactly this schema's params
+        if len(name_split) != len(self._param_names) + 2:
+            return None
+        params = {}
+        for i, param_name in enumerate(self._param_names):
+            param_str = name_split[i + 2]
+            sep = param_str.find(':')
+            if sep < 0:
+                if param_name != _positional_param_name(i + 2):
+                    return self._parse_by_name(name_split)
+                val_str = param_str
+            else:
+                key = param_str[:sep]
+                if key != param_name and key != '[' + param_name + ']':
+                    return self._parse_by_name(name_split)
+                val_str = param_str[sep + 1:]
+            params[param_name] = self._convert(i, val_str)
+        return params
+
+    def _parse_by_name(self, name_split):
+        # Slow path for names with the same params in a different order
+        val_strs = {}
+        for i in range(2, len(name_split)):
+            param_name, val_str = _split_param(name_split[i], i)
+            if param_name not in self._param_names or param_name in val_strs:
+                return None
+            val_strs[param_name] = val_str
+        return {param_name: self._convert(i, val_strs[param_name])
+                for i, param_name in enumerate(self._param_names)}
+
+def _positional_param_name(position):
+    return 'arg{}'.format(position - 2)
+
+def _split_param(param_str, position):
+    sep = param_str.find(':')
+    # Params without a name are named after their position
+    if sep < 0:
+        return _positional_param_name(position), param_str
+    # Ignore brackets around param names for now
+    param_name = param_str[:sep].translate({ord(char): None for char in '[]'})
+    return param_name, param_str[sep + 1:]
+
+class ParamColumn:
+    # Ints and floats are packed into typed arrays, strings are
+    # dictionary-encoded
+    def __init__(self, param_type):
+        self._param_type = param_type
+        self._vals = array(_param_typecodes[param_type])
+        self._dictionary = []
+        self._codes = {}
+
+    @property
+    def param_type(self):
+        return self._param_type
+
+    def __len__(self):
+        return len(self._vals)
+
+    def append(self, val):
+        if self._param_type == ParamTypes.str:
+            val = _param_val_str(val)
+            code = self._codes.get(val)
+            if code is None:
+                code = len(self._dictionary)
+                self._codes[val] = code
+                self._dictionary.append(val)
+            self._vals.append(code)
+            return
+        try:
+            self._vals.append(val)
+        except (TypeError, OverflowError):
+            # The schema widened the param's type after this column was created
+            self.widen(ParamTypes.str if isinstance(val, str) else ParamTypes.float)
+            self.append(val)
+
+    def widen(self, param_type):
+        if _param_type_order.index(param_type) <= _param_type_order.index(self._param_type):
+            return
+        vals = self.tolist()
+        self.__init__(param_type)
+        convert = _param_converters[param_type]
+        for val in vals:
+            self.append(convert(val))
+
+    @property
+    def typecode(self):
+        return self._vals.typecode
+
+    @property
+    def dictionary(self):
+        return deepcopy(self._dictionary)
+
+    def tobytes(self):
+        return self._vals.tobytes()
+
+    def tolist(self):
+        if self._param_type == ParamTypes.str:
+            return [self._dictionary[code] for code in self._vals]
+        return self._vals.tolist()
+
+def _run_name(result_json):
+    # Aggregate results (mean, median, ...) append the aggregate's name to the
+    # name of the run they summarize, e.g. fft1/f32/dim0:16_mean
+    name_str = result_json[Attributes.name]
+    if result_json.get(Attributes.run_type) == RunTypes.aggregate:
+        if Attributes.run_name in result_json:
+            return result_json[Attributes.run_name]
+        suffix = '_' + result_json.get(Attributes.aggregate_name, '')
+        if len(suffix) > 1 and name_str.endswith(suffix):
+            return name_str[:-len(suffix)]
+    return name_str
+
 class Result:
-    def __init__(self, result_json):
+    def __init__(self, result_json, schemas=None):
         self._result_json = result_json
-        self._params = {}
-        name_str = self._result_json[Attributes.name]
+        name_str = _run_name(self._result_json)
+        self._run_name = name_str
         name_split = name_str.split('/')
         # Assumption: 'name' is always benchmark_name/dtype/param:val/param:val/...
         self._benchmark_name = name_split[0]
         self._dtype = name_split[1]
-        for i in range(2, len(name_split)):
-            param_str = name_split[i].split(':')
-            # Ignore brackets around param names for now
-            param_name = param_str[0].translate({ord(char): None for char in '[]'})
-            # Assumption: param values are always ints
-            self._params[param_name] = int(param_str[1])
+
+        self._schema = None
+        self._params = None
+        if schemas is not None:
+            self._schema = schemas.get(self._benchmark_name)
+        if self._schema is not None:
+            self._params = self._schema.parse(name_split)
+        if self._params is None:
+            # Either the first result of this benchmark, or one whose params
+            # differ from the cached schema's
+            cached_schema = self._schema
+            self._schema = ParamSchema(name_split)
+            self._params = self._schema.parse(name_split)
+            if schemas is not None and cached_schema is None:
+                schemas[self._benchmark_name] = self._schema
+            elif cached_schema is not None:
+                # Don't lose the types of the params both schemas share
+                cached_names = cached_schema.param_names
+                for param_name in self._schema.param_names:
+                    if param_name in cached_names:
+                        cached_schema.widen(param_name, self._schema.param_type(param_name))
+
+    @property
+    def schema(self):
+        return self._schema
+
+    @property
+    def run_name(self):
+        return self._run_name
 
     @property
     def benchmark_name(self):
@@ -81,11 +359,32 @@ class Result:
     def time_unit(self):
         return self._result_json[Attributes.time_unit]
 
+    def has_column(self, column):
+        if column in (Columns.benchmark, Columns.dtype) or column in self._result_json:
+            return True
+        if column.startswith(Columns.param_prefix):
+            column = column[len(Columns.param_prefix):]
+        return column in self._params
+
+    def column_val(self, column):
+        if column == Columns.benchmark:
+            return self._benchmark_name
+        if column == Columns.dtype:
+            return self._dtype
+        if column.startswith(Columns.param_prefix):
+            return self._params.get(column[len(Columns.param_prefix):])
+        # Result attributes win over params of the same name (e.g. the
+        # iterations param of topkMemK); those are reachable as param.<name>
+        if column in self._result_json:
+            return self._result_json[column]
+        return self._params.get(column)
+
     def passes_filters(self, constraints):
         is_pass = True
         for k, v in constraints.items():
             if k in self._params:
-                is_pass = is_pass and self._params[k] == v
+                is_pass = is_pass and param_vals_equal(
+                    self._schema.param_type(k), self._params[k], v)
             else:
                 # Probably should throw an exception here
                 is_pass = False
@@ -110,13 +409,19 @@ class Benchmark:
         self._time_units = {}
 
         self._first_iter = True
+        self._schemas = {}
 
         json_doc = None
         with open(filepath) as bench_file:
             json_doc = json.load(bench_file)
 
+        name_prefix = name + '/'
         for result in json_doc['benchmarks']:
-            _result = Result(result)
+            # Skip other benchmarks' results before parsing their names
+            if not result[Attributes.name].startswith(name_prefix):
+                continue
+
+            _result = Result(result, self._schemas)
 
             if _result.benchmark_name == name:
                 # Assumption: all param names within a benchmark are the same
@@ -129,7 +434,8 @@ class Benchmark:
                     self._avail_dtypes.append(_result.dtype)
                     self._param_vals[_result.dtype] = {}
                     for param in self._avail_params:
-                        self._param_vals[_result.dtype][param] = []
+                        self._param_vals[_result.dtype][param] = ParamColumn(
+                            _result.schema.param_type(param))
                     self._run_types[_result.dtype] = []
                     self._iterations[_result.dtype] = []
                     self._real_times[_result.dtype] = []
@@ -146,6 +452,10 @@ class Benchmark:
                     self._time_units[_result.dtype].append(_result.time_unit)
 
         self._avail_dtypes.sort()
+        # Filtered out results may still have widened a param's type
+        for dtype in self._avail_dtypes:
+            for param in self._avail_params:
+                self._param_vals[dtype][param].widen(self.param_type(param))
 
     @property
     def name(self):
@@ -167,8 +477,11 @@ class Benchmark:
     def avail_params(self):
         return deepcopy(self._avail_params)
 
+    def param_type(self, param_name):
+        return self._schemas[self._name].param_type(param_name)
+
     def collect_param_vals(self, param_name, dtype):
-        return deepcopy(self._param_vals[dtype][param_name])
+        return self._param_vals[dtype][param_name].tolist()
 
     def collect_run_types(self, dtype):
         return deepcopy(self._run_types[dtype])
@@ -194,13 +507,14 @@ class BenchmarkInfo():
         self._paramvals = {}
         self._minparamval = {}
         self._first_iter = True
+        self._schemas = {}
 
         json_doc = None
         with open(filepath) as bench_file:
             json_doc = json.load(bench_file)
 
         for result in json_doc['benchmarks']:
-            _result = Result(result)
+            _result = Result(result, self._schemas)
 
             # Assumption: all benchmark attributes within the file are the same
             if self._first_iter:
@@ -223,20 +537,23 @@ class BenchmarkInfo():
                 self._minparamval[benchmark_name][_result.dtype] = {}
                 for param in self._params[benchmark_name]:
                     self._paramvals[benchmark_name][_result.dtype][param] = []
-                    self._minparamval[benchmark_name][_result.dtype][param] = _result.params[param]
 
             for param in self._params[benchmark_name]:
                 if _result.params[param] not in self._paramvals[benchmark_name][_result.dtype][param]:
                     self._paramvals[benchmark_name][_result.dtype][param].append(_result.params[param])
-                if _result.params[param] < self._minparamval[benchmark_name][_result.dtype][param]:
-                    self._minparamval[benchmark_name][param] = _result.params[param]
 
         self._benchmark_names.sort()
         for benchmark_name in self._benchmark_names:
             self._dtypes[benchmark_name].sort()
             for param in self._params[benchmark_name]:
+                # A param's type may have widened after its first values were
+                # collected, so bring them all to the final type before sorting
+                convert = _param_converters[self.param_type(benchmark_name, param)]
                 for dtype in self._dtypes[benchmark_name]:
-                    self._paramvals[benchmark_name][dtype][param].sort()
+                    paramvals = self._paramvals[benchmark_name][dtype][param]
+                    paramvals = sorted(set(convert(val) for val in paramvals))
+                    self._paramvals[benchmark_name][dtype][param] = paramvals
+                    self._minparamval[benchmark_name][dtype][param] = paramvals[0]
 
     @property
     def benchmark_names(self):
@@ -248,6 +565,9 @@ class BenchmarkInfo():
     def params(self, benchmark_name):
         return deepcopy(self._params[benchmark_name])
 
+    def param_type(self, benchmark_name, param):
+        return self._schemas[benchmark_name].param_type(param)
+
     @property
     def attributes(self):
         return deepcopy(self._attributes)
@@ -257,3 +577,879 @@ class BenchmarkInfo():
 
     def minparamval(self, benchmark_name, dtype, param):
         return self._minparamval[benchmark_name][dtype][param]
+
+_benchmarks_key_re = re.compile(r'"benchmarks"\s*:\s*\[')
+_whitespace_re = re.compile(r'[\s,]*')
+
+# Yields the results of a benchmark file one by one, without loading the whole
+# document
+def iter_results(filepath, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    with open(filepath) as bench_file:
+        buf = ''
+        pos = -1
+        while pos < 0:
+            chunk = bench_file.read(chunk_size)
+            if not chunk:
+                return
+            buf += chunk
+            match = _benchmarks_key_re.search(buf)
+            if match:
+                pos = match.end()
+            else:
+                # Keep enough of the tail in case the key straddles two chunks
+                buf = buf[-64:]
+
+        eof = False
+        while True:
+            pos = _whitespace_re.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                result, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                chunk = bench_file.read(chunk_size)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield result
+
+def parse_param_filter(filter_str):
+    param_name, val_str = _split_param(filter_str, 2)
+    return param_name, _param_converters[infer_param_type(val_str)](val_str)
+
+class Columns:
+    name = Attributes.name
+    benchmark = 'benchmark'
+    dtype = 'dtype'
+    param_prefix = 'param.'
+
+_default_columns = [Columns.name, Attributes.real_time, Attributes.cpu_time,
+                    Attributes.time_unit]
+
+def query(filepaths, benchmark=None, dtype=None, filters={}):
+    prefix = ''
+    if benchmark is not None:
+        prefix = benchmark + '/'
+        if dtype is not None:
+            prefix += dtype + '/'
+    schemas = {}
+    for filepath in filepaths:
+        for result in iter_results(filepath):
+            if not result[Attributes.name].startswith(prefix):
+                continue
+            _result = Result(result, schemas)
+            if dtype is not None and _result.dtype != dtype:
+                continue
+            if _result.passes_filters(filters):
+                yield _result
+
+_missing_param_vals = {
+    ParamTypes.int: 0,
+    ParamTypes.float: math.nan,
+    ParamTypes.str: ''
+}
+
+# Columnar copy of benchmark results, packed into one flat buffer:
+#   magic | header length | JSON header | 8-byte aligned column arrays
+# The buffer can be placed in shared memory and viewed by other processes
+# without copying or unpickling anything.
+# Attributes have one column over all the results. Params have one column per
+# benchmark, since the same param name may have different types in different
+# benchmarks, plus a column mapping the benchmark's positions to result rows
+class ResultTable:
+    magic = b'AFBT'
+    _prefix = struct.Struct('<4sI')
+    _position = 'position'
+    _attribute_types = [
+        (Attributes.run_type, ParamTypes.str),
+        (Attributes.iterations, ParamTypes.int),
+        (Attributes.real_time, ParamTypes.float),
+        (Attributes.cpu_time, ParamTypes.float),
+        (Attributes.time_unit, ParamTypes.str)
+    ]
+
+    def __init__(self, buf):
+        magic, header_len = self._prefix.unpack_from(buf)
+        if magic != self.magic:
+            raise ValueError('Not a result table buffer')
+        header_start = self._prefix.size
+        self._header = json.loads(bytes(buf[header_start:header_start + header_len]).decode('utf-8'))
+        self._buf = buf
+        self._shm = None
+        self._views = []
+        self._columns = {column['name']: self._view_column(column)
+                         for column in self._header['columns']}
+        self._benchmarks = {}
+        for benchmark_name, benchmark in self._header['benchmarks'].items():
+            param_columns = {column['name']: self._view_column(column)
+                             for column in benchmark['param_columns']}
+            self._benchmarks[benchmark_name] = (self._view_column(benchmark['rows']), param_columns)
+
+    def _view_column(self, column):
+        start = column['offset']
+        view = self._buf[start:start + column['size']].cast(column['typecode'])
+        self._views.append(view)
+        return view, column['dictionary'], column['type']
+
+    @classmethod
+    def from_file(cls, filepath):
+        return cls(memoryview(cls.pack(iter_results(filepath))))
+
+    @classmethod
+    def pack(cls, results):
+        columns = [(Columns.benchmark, ParamColumn(ParamTypes.str)),
+                   (Columns.dtype, ParamColumn(ParamTypes.str)),
+                   (cls._position, ParamColumn(ParamTypes.int))]
+        columns += [(name, ParamColumn(param_type)) for name, param_type in cls._attribute_types]
+        benchmarks = {}
+        schemas = {}
+        rows = 0
+        for result in results:
+            _result = Result(result, schemas)
+            benchmark = benchmarks.get(_result.benchmark_name)
+            if benchmark is None:
+                benchmark = (ParamColumn(ParamTypes.int), {})
+                benchmarks[_result.benchmark_name] = benchmark
+            bench_rows, param_columns = benchmark
+            position = len(bench_rows)
+            bench_rows.append(rows)
+
+            columns[0][1].append(_result.benchmark_name)
+            columns[1][1].append(_result.dtype)
+            columns[2][1].append(position)
+            for name, column in columns[3:]:
+                val = result.get(name)
+                column.append(val if val is not None else _missing_param_vals[column.param_type])
+
+            params = _result.params
+            for param_name, val in params.items():
+                column = param_columns.get(param_name)
+                if column is None:
+                    column = ParamColumn(_result.schema.param_type(param_name))
+                    for _ in range(position):
+                        column.append(_missing_param_vals[column.param_type])
+                    param_columns[param_name] = column
+                column.append(val)
+            for param_name, column in param_columns.items():
+                if param_name not in params:
+                    column.append(_missing_param_vals[column.param_type])
+            rows += 1
+
+        header = {
+            'rows': rows,
+            'columns': [],
+            'benchmarks': {}
+        }
+        column_headers = []
+        def add_column(name, column):
+            column_header = {
+                'name': name,
+                'type': column.param_type,
+                'typecode': column.typecode,
+                'dictionary': column.dictionary if column.param_type == ParamTypes.str else None,
+                'offset': 0,
+                'size': len(column) * 8
+            }
+            column_headers.append((column_header, column))
+            return column_header
+
+        for name, column in columns:
+            header['columns'].append(add_column(name, column))
+        for benchmark_name, (bench_rows, param_columns) in sorted(benchmarks.items()):
+            schema = schemas[benchmark_name]
+            for param_name, column in param_columns.items():
+                if param_name in schema.param_names:
+                    column.widen(schema.param_type(param_name))
+            header['benchmarks'][benchmark_name] = {
+                'params': sorted(schema.param_names),
+                'rows': add_column(cls._position, bench_rows),
+                'param_columns': [add_column(param_name, column)
+                                  for param_name, column in sorted(param_columns.items())]
+            }
+
+        # Offsets depend on the header's length, which depends on the offsets,
+        # so grow the space reserved for the header until it fits
+        header_len = len(json.dumps(header).encode('utf-8'))
+        while True:
+            offset = _align(cls._prefix.size + header_len)
+            for column_header, _ in column_headers:
+                column_header['offset'] = offset
+                offset = _align(offset + column_header['size'])
+            header_bytes = json.dumps(header).encode('utf-8')
+            if len(header_bytes) <= header_len:
+                break
+            header_len = len(header_bytes)
+
+        buf = bytearray(offset)
+        cls._prefix.pack_into(buf, 0, cls.magic, header_len)
+        header_start = cls._prefix.size
+        # Pad with spaces, which JSON ignores
+        buf[header_start:header_start + header_len] = header_bytes.ljust(header_len)
+        for column_header, column in column_headers:
+            start = column_header['offset']
+            buf[start:start + column_header['size']] = column.tobytes()
+        return buf
+
+    @property
+    def nbytes(self):
+        return len(self._buf)
+
+    @property
+    def rows(self):
+        return self._header['rows']
+
+    @property
+    def benchmark_names(self):
+        return sorted(self._header['benchmarks'].keys())
+
+    def params(self, benchmark_name):
+        return deepcopy(self._header['benchmarks'][benchmark_name]['params'])
+
+    def param_type(self, benchmark_name, param_name):
+        return self._benchmarks[benchmark_name][1][param_name][2]
+
+    # dtypes() and paramvals() are computed from the columns on each call, so
+    # that processes sharing the table don't each hold their own copy
+    def dtypes(self, benchmark_name):
+        return sorted(set(self.collect(Columns.dtype, self.select(benchmark_name))))
+
+    def paramvals(self, benchmark_name, dtype, param_name):
+        rows = self.select(benchmark_name, dtype)
+        # NaN only ever fills in for a missing param, since 'nan' params are strs
+        return sorted(set(val for val in self.collect_param_vals(param_name, rows)
+                          if val is not None and val == val))
+
+    def to_shared_memory(self):
+        # The caller owns the returned segment, and must close() and unlink()
+        # it once every process is done with it
+        if shared_memory is None:
+            raise RuntimeError('Shared memory requires Python 3.8 or later')
+        shm = shared_memory.SharedMemory(create=True, size=len(self._buf))
+        shm.buf[:len(self._buf)] = self._buf
+        return shm
+
+    @classmethod
+    def attach(cls, name):
+        if shared_memory is None:
+            raise RuntimeError('Shared memory requires Python 3.8 or later')
+        shm = shared_memory.SharedMemory(name=name)
+        table = cls(shm.buf.toreadonly())
+        table._shm = shm
+        return table
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._columns = {}
+        self._benchmarks = {}
+        self._buf.release()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def _code(self, dictionary, val):
+        try:
+            return dictionary.index(val)
+        except ValueError:
+            return None
+
+    def _filter(self, column, val, positions, rows_view=None):
+        # Keeps the positions whose value in the column matches val, compared
+        # the same way as Result.passes_filters
+        view, dictionary, param_type = column
+        if rows_view is not None:
+            positions_view = [(i, rows_view[i]) for i in positions]
+        else:
+            positions_view = [(i, i) for i in positions]
+        if dictionary is not None:
+            code = self._code(dictionary, _param_val_str(val))
+            return [i for i, j in positions_view if view[j] == code] if code is not None else []
+        if _param_type_of(val) != ParamTypes.str:
+            return [i for i, j in positions_view if view[j] == val]
+        return [i for i, j in positions_view if param_vals_equal(param_type, view[j], val)]
+
+    def select(self, benchmark_name, dtype=None, filters={}, run_type=None):
+        # Row indices of the matching results, in file order
+        benchmark = self._benchmarks.get(benchmark_name)
+        if benchmark is None:
+            return []
+        (rows_view, _, _), param_columns = benchmark
+        positions = range(len(rows_view))
+        if dtype is not None:
+            positions = self._filter(self._columns[Columns.dtype], dtype, positions, rows_view)
+        if run_type is not None:
+            positions = self._filter(self._columns[Attributes.run_type], run_type, positions,
+                                     rows_view)
+        for param_name, param_val in filters.items():
+            if param_name not in param_columns:
+                # Probably should throw an exception here
+                return []
+            positions = self._filter(param_columns[param_name], param_val, positions)
+        return [rows_view[i] for i in positions]
+
+    def _decode(self, column, i):
+        view, dictionary, _ = column
+        return dictionary[view[i]] if dictionary is not None else view[i]
+
+    def collect(self, column, rows):
+        column = self._columns[column]
+        return [self._decode(column, i) for i in rows]
+
+    def collect_param_vals(self, param_name, rows):
+        benchmark_column = self._columns[Columns.benchmark]
+        position_view = self._columns[self._position][0]
+        vals = []
+        for i in rows:
+            param_columns = self._benchmarks[self._decode(benchmark_column, i)][1]
+            if param_name in param_columns:
+                vals.append(self._decode(param_columns[param_name], position_view[i]))
+            else:
+                vals.append(None)
+        return vals
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+class TimeUnits:
+    ns = 'ns'
+    us = 'us'
+    ms = 'ms'
+    s = 's'
+
+_time_unit_factors = {
+    TimeUnits.ns: 1.0,
+    TimeUnits.us: 1e3,
+    TimeUnits.ms: 1e6,
+    TimeUnits.s: 1e9
+}
+
+def convert_time(time, from_unit, to_unit):
+    return time * _time_unit_factors[from_unit] / _time_unit_factors[to_unit]
+
+# Count, mean, variance, min and max of a stream of values, using Welford's
+# algorithm. Two instances can be merged without seeing the original values
+class RunningStats:
+    def __init__(self):
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._min = math.inf
+        self._max = -math.inf
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._mean if self._count > 0 else None
+
+    @property
+    def variance(self):
+        return self._m2 / (self._count - 1) if self._count > 1 else None
+
+    @property
+    def stddev(self):
+        variance = self.variance
+        return math.sqrt(variance) if variance is not None else None
+
+    @property
+    def min(self):
+        return self._min if self._count > 0 else None
+
+    @property
+    def max(self):
+        return self._max if self._count > 0 else None
+
+    def add(self, val):
+        self._count += 1
+        delta = val - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (val - self._mean)
+        self._min = min(self._min, val)
+        self._max = max(self._max, val)
+
+    def merge(self, other):
+        if other._count == 0:
+            return
+        count = self._count + other._count
+        delta = other._mean - self._mean
+        self._mean += delta * other._count / count
+        self._m2 += other._m2 + delta * delta * self._count * other._count / count
+        self._count = count
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+
+    def to_json(self):
+        return [self._count, self._mean, self._m2, self._min, self._max]
+
+    @classmethod
+    def from_json(cls, stats_json):
+        stats = cls()
+        stats._count, stats._mean, stats._m2, stats._min, stats._max = stats_json
+        return stats
+
+# Merging t-digest (Dunning & Ertl) for approximate quantiles. The number of
+# centroids is bounded by the compression, whatever the number of values added
+class TDigest:
+    def __init__(self, compression=100):
+        self._compression = compression
+        self._centroids = []
+        self._buffer = []
+        self._total = 0.0
+        self._min = math.inf
+        self._max = -math.inf
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def count(self):
+        return self._total
+
+    def add(self, val, weight=1.0):
+        self._buffer.append([val, weight])
+        self._total += weight
+        self._min = min(self._min, val)
+        self._max = max(self._max, val)
+        if len(self._buffer) >= 5 * self._compression:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        self._buffer.extend([mean, weight] for mean, weight in other._centroids)
+        self._total += other._total
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+        self._compress()
+
+    def _k(self, q):
+        return self._compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q(self, k):
+        if k >= self._compression / 4:
+            return 1.0
+        return (math.sin(2 * math.pi * k / self._compression) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        centroids = sorted(self._centroids + self._buffer)
+        self._buffer = []
+        merged = [centroids[0]]
+        weight_so_far = 0.0
+        q_limit = self._q(self._k(0.0) + 1)
+        for mean, weight in centroids[1:]:
+            curr = merged[-1]
+            if (weight_so_far + curr[1] + weight) / self._total <= q_limit:
+                curr[0] += (mean - curr[0]) * weight / (curr[1] + weight)
+                curr[1] += weight
+            else:
+                weight_so_far += curr[1]
+                q_limit = self._q(self._k(weight_so_far / self._total) + 1)
+                merged.append([mean, weight])
+        self._centroids = merged
+
+    def quantile(self, q):
+        self._compress()
+        if not self._centroids:
+            return None
+        if len(self._centroids) == 1:
+            return self._centroids[0][0]
+        target = q * self._total
+        # Centroids are treated as points at their cumulative midpoints, with
+        # the min and max at the ends
+        prev_pos = 0.0
+        prev_val = self._min
+        cum_weight = 0.0
+        for mean, weight in self._centroids:
+            pos = cum_weight + weight / 2
+            if target < pos:
+                return _interpolate(target, prev_pos, pos, prev_val, mean)
+            prev_pos = pos
+            prev_val = mean
+            cum_weight += weight
+        return _interpolate(target, prev_pos, self._total, prev_val, self._max)
+
+    def cdf(self, val):
+        self._compress()
+        if not self._centroids:
+            return None
+        if val < self._min:
+            return 0.0
+        if val >= self._max:
+            return 1.0
+        prev_pos = 0.0
+        prev_val = self._min
+        cum_weight = 0.0
+        for mean, weight in self._centroids:
+            pos = cum_weight + weight / 2
+            if val < mean:
+                return _interpolate(val, prev_val, mean, prev_pos, pos) / self._total
+            prev_pos = pos
+            prev_val = mean
+            cum_weight += weight
+        return _interpolate(val, prev_val, self._max, prev_pos, self._total) / self._total
+
+    def to_json(self):
+        self._compress()
+        return [self._compression, self._min, self._max, self._centroids]
+
+    @classmethod
+    def from_json(cls, digest_json):
+        compression, min_val, max_val, centroids = digest_json
+        digest = cls(compression)
+        digest._min = min_val
+        digest._max = max_val
+        digest._centroids = [list(centroid) for centroid in centroids]
+        digest._total = float(sum(weight for _, weight in digest._centroids))
+        return digest
+
+def _interpolate(x, x0, x1, y0, y1):
+    if x1 <= x0:
+        return y1
+    return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+class Sketch:
+    def __init__(self, stats=None, digest=None, compression=100):
+        self._stats = stats if stats is not None else RunningStats()
+        self._digest = digest if digest is not None else TDigest(compression)
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def digest(self):
+        return self._digest
+
+    def add(self, val):
+        self._stats.add(val)
+        self._digest.add(val)
+
+    def merge(self, other):
+        self._stats.merge(other._stats)
+        self._digest.merge(other._digest)
+
+    def to_json(self):
+        return {'stats': self._stats.to_json(), 'digest': self._digest.to_json()}
+
+    @classmethod
+    def from_json(cls, sketch_json):
+        return cls(RunningStats.from_json(sketch_json['stats']),
+                   TDigest.from_json(sketch_json['digest']))
+
+# Running real_time statistics per (benchmark, dtype, params), folded in from
+# result files and persisted as sketches instead of raw results
+class Aggregator:
+    format_version = 1
+    # All times are kept in a single unit, whatever the files used
+    time_unit = TimeUnits.ns
+
+    def __init__(self, compression=100):
+        self._compression = compression
+        self._sketches = {}
+        self._schemas = {}
+        # Content digests of the files folded in so far
+        self._files = set()
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def keys(self):
+        return sorted(self._sketches.keys())
+
+    def sketch(self, key):
+        return self._sketches[key]
+
+    @staticmethod
+    def key(_result):
+        # The result's name with brackets removed from param names. Values
+        # are kept as written, not as parsed, since the parsed type depends on
+        # which other results were seen before
+        name_split = _result.run_name.split('/')
+        parts = name_split[:2]
+        for i in range(2, len(name_split)):
+            parts.append('{}:{}'.format(*_split_param(name_split[i], i)))
+        return '/'.join(parts)
+
+    def _real_time(self, _result):
+        return convert_time(_result.real_time, _result.time_unit, self.time_unit)
+
+    def add_result(self, result_json):
+        # Aggregate rows (mean, median, ...) are already summaries
+        if result_json.get(Attributes.run_type, RunTypes.iteration) != RunTypes.iteration:
+            return
+        _result = Result(result_json, self._schemas)
+        key = self.key(_result)
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            sketch = Sketch(compression=self._compression)
+            self._sketches[key] = sketch
+        sketch.add(self._real_time(_result))
+
+    def add_file(self, filepath):
+        # Returns False, without adding anything, for a file whose contents
+        # were already folded in
+        file_digest = _file_digest(filepath)
+        if file_digest in self._files:
+            return False
+        for result in iter_results(filepath):
+            self.add_result(result)
+        self._files.add(file_digest)
+        return True
+
+    def merge(self, other):
+        # Files folded into both histories get counted twice; there's no way
+        # to take them back out of the sketches, so they are only reported
+        duplicate_files = self._files & other._files
+        self._files |= other._files
+        for key, other_sketch in other._sketches.items():
+            sketch = self._sketches.get(key)
+            if sketch is None:
+                sketch = Sketch(compression=self._compression)
+                self._sketches[key] = sketch
+            sketch.merge(other_sketch)
+        return duplicate_files
+
+    def score(self, result_json):
+        _result = Result(result_json, self._schemas)
+        key = self.key(_result)
+        real_time = self._real_time(_result)
+        score = {
+            'key': key,
+            Attributes.real_time: real_time,
+            Attributes.time_unit: self.time_unit,
+            'count': 0,
+            'mean': None,
+            'stddev': None,
+            'zscore': None,
+            'percentile': None
+        }
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            return score
+        stats = sketch.stats
+        score['count'] = stats.count
+        score['mean'] = stats.mean
+        score['stddev'] = stats.stddev
+        if stats.stddev:
+            score['zscore'] = (real_time - stats.mean) / stats.stddev
+        score['percentile'] = sketch.digest.cdf(real_time)
+        return score
+
+    def summary(self, key):
+        sketch = self._sketches[key]
+        stats = sketch.stats
+        return {
+            'key': key,
+            Attributes.time_unit: self.time_unit,
+            'count': stats.count,
+            'mean': stats.mean,
+            'variance': stats.variance,
+            'min': stats.min,
+            'max': stats.max,
+            'p50': sketch.digest.quantile(0.5),
+            'p95': sketch.digest.quantile(0.95),
+            'p99': sketch.digest.quantile(0.99)
+        }
+
+    def save(self, filepath):
+        doc = {
+            'version': self.format_version,
+            Attributes.time_unit: self.time_unit,
+            'compression': self._compression,
+            'files': sorted(self._files),
+            'sketches': {key: sketch.to_json() for key, sketch in self._sketches.items()}
+        }
+        # Write next to the destination and swap, so a crash never leaves a
+        # truncated history behind
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'w') as sketch_file:
+            json.dump(doc, sketch_file, separators=(',', ':'))
+        os.replace(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath) as sketch_file:
+            doc = json.load(sketch_file)
+        if doc['version'] != cls.format_version:
+            raise ValueError('Unsupported sketch file version {} in {}'.format(
+                doc['version'], filepath))
+        aggregator = cls(doc['compression'])
+        aggregator._files = set(doc.get('files', []))
+        for key, sketch_json in doc['sketches'].items():
+            aggregator._sketches[key] = Sketch.from_json(sketch_json)
+        return aggregator
+
+def _file_digest(filepath, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as bench_file:
+        for chunk in iter(lambda: bench_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _expand_filepaths(patterns):
+    filepaths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        # Let open() report files that don't exist
+        filepaths.extend(matches if matches else [pattern])
+    return filepaths
+
+class OutputFormats:
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+def _run_query(args):
+    columns = args.columns.split(',') if args.columns else _default_columns
+    filters = dict(parse_param_filter(filter_str) for filter_str in args.param)
+    results = iter(query(_expand_filepaths(args.files), args.benchmark, args.dtype, filters))
+    # Fail before writing anything if a column is misspelled, rather than
+    # emitting a column of nulls
+    first_result = next(results, None)
+    if first_result is not None:
+        unknown_columns = [column for column in columns if not first_result.has_column(column)]
+        if unknown_columns:
+            sys.exit('afbench: unknown column(s) {} for {}; expected name, benchmark, '
+                     'dtype, a result attribute or a param'.format(
+                         ', '.join(unknown_columns), first_result[Attributes.name]))
+        results = itertools.chain([first_result], results)
+    _write_rows(([_result.column_val(column) for column in columns]
+                 for _result in results), columns, args.format)
+
+def _write_rows(rows, columns, output_format):
+    out = io.open(sys.stdout.fileno(), 'w', buffering=OUTPUT_BUFFER_SIZE,
+                  encoding='utf-8', newline='', closefd=False)
+    try:
+        if output_format == OutputFormats.csv:
+            writer = csv.writer(out, lineterminator='\n')
+            writer.writerow(columns)
+            writer.writerows(rows)
+        else:
+            encoder = json.JSONEncoder(separators=(',', ':'))
+            for row in rows:
+                out.write(encoder.encode(dict(zip(columns, row))))
+                out.write('\n')
+        out.flush()
+    except BrokenPipeError:
+        # The reader went away (e.g. piped into head); nothing left to do
+        pass
+
+_score_columns = ['key', Attributes.real_time, Attributes.time_unit, 'count',
+                  'mean', 'stddev', 'zscore', 'percentile']
+_summary_columns = ['key', Attributes.time_unit, 'count', 'mean', 'variance',
+                    'min', 'max', 'p50', 'p95', 'p99']
+
+_default_compression = 100
+
+def _run_aggregate(args):
+    if os.path.exists(args.output):
+        aggregator = Aggregator.load(args.output)
+        if args.compression is not None and args.compression != aggregator.compression:
+            sys.exit('afbench: {} was created with --compression {}, not {}'.format(
+                args.output, aggregator.compression, args.compression))
+    else:
+        aggregator = Aggregator(args.compression or _default_compression)
+    for filepath in _expand_filepaths(args.files):
+        if not aggregator.add_file(filepath):
+            print('afbench: skipping {}, already in {}'.format(filepath, args.output),
+                  file=sys.stderr)
+    for filepath in _expand_filepaths(args.merge):
+        duplicate_files = aggregator.merge(Aggregator.load(filepath))
+        if duplicate_files:
+            print('afbench: warning: {} file(s) in {} were already in {} and are '
+                  'now counted twice'.format(len(duplicate_files), filepath, args.output),
+                  file=sys.stderr)
+    aggregator.save(args.output)
+
+def _run_score(args):
+    aggregator = Aggregator.load(args.history)
+    scores = (aggregator.score(result)
+              for filepath in _expand_filepaths(args.files)
+              for result in iter_results(filepath)
+              if result.get(Attributes.run_type, RunTypes.iteration) == RunTypes.iteration)
+    _write_rows(([score[column] for column in _score_columns] for score in scores),
+                _score_columns, args.format)
+
+def _run_summary(args):
+    aggregator = Aggregator.load(args.history)
+    summaries = (aggregator.summary(key) for key in aggregator.keys)
+    _write_rows(([summary[column] for column in _summary_columns] for summary in summaries),
+                _summary_columns, args.format)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='afbench')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    query_parser = subparsers.add_parser(
+        'query', help='stream matching results as NDJSON or CSV')
+    query_parser.add_argument('files', nargs='+',
+                              help='benchmark JSON files or glob patterns')
+    query_parser.add_argument('-b', '--benchmark', help='benchmark name, e.g. fft2')
+    query_parser.add_argument('-d', '--dtype', help='dtype, e.g. c32')
+    query_parser.add_argument('-p', '--param', action='append', default=[],
+                              help='param filter as param:val, e.g. dim1:16 '
+                              '(may be repeated)')
+    query_parser.add_argument('-c', '--columns',
+                              help='comma-separated columns to output; any of '
+                              'name, benchmark, dtype, a result attribute or a '
+                              'param. Attributes take precedence over params of '
+                              'the same name; use param.<name> to always get '
+                              'the param. Columns unknown to the first matching '
+                              'result are an error; results further on that '
+                              'lack a column output it as null/empty '
+                              '(default: {})'.format(','.join(_default_columns)))
+    query_parser.add_argument('-f', '--format', default=OutputFormats.ndjson,
+                              choices=[OutputFormats.ndjson, OutputFormats.csv])
+    query_parser.set_defaults(func=_run_query)
+
+    aggregate_parser = subparsers.add_parser(
+        'aggregate', help='fold result files into a history of running statistics; '
+        'files already in the history are skipped')
+    aggregate_parser.add_argument('-o', '--output', required=True,
+                                  help='history file; updated in place if it exists')
+    aggregate_parser.add_argument('-m', '--merge', action='append', default=[],
+                                  help='another history file to merge in, e.g. '
+                                  'from another machine (may be repeated)')
+    aggregate_parser.add_argument('--compression', type=int,
+                                  help='t-digest compression for a new history; '
+                                  'higher is more accurate but larger (default: '
+                                  '{}). An existing history keeps its own'.format(
+                                      _default_compression))
+    aggregate_parser.add_argument('files', nargs='*',
+                                  help='benchmark JSON files or glob patterns')
+    aggregate_parser.set_defaults(func=_run_aggregate)
+
+    score_parser = subparsers.add_parser(
+        'score', help='score results\' real_time against a history')
+    score_parser.add_argument('history', help='history file')
+    score_parser.add_argument('files', nargs='+',
+                              help='benchmark JSON files or glob patterns')
+    score_parser.add_argument('-f', '--format', default=OutputFormats.ndjson,
+                              choices=[OutputFormats.ndjson, OutputFormats.csv])
+    score_parser.set_defaults(func=_run_score)
+
+    summary_parser = subparsers.add_parser(
+        'summary', help='output the statistics of every key in a history')
+    summary_parser.add_argument('history', help='history file')
+    summary_parser.add_argument('-f', '--format', default=OutputFormats.ndjson,
+                                choices=[OutputFormats.ndjson, OutputFormats.csv])
+    summary_parser.set_defaults(func=_run_summary)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
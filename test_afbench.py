@@ -0,0 +1,411 @@
+from afbench import (Aggregator, Attributes, Benchmark, BenchmarkInfo, ParamTypes, ResultTable,
+                     RunningStats, RunTypes, TDigest, main, shared_memory)
+
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+AFBENCH = os.path.join(os.path.dirname(__file__), 'afbench.py')
+BENCHMARK_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'benchmarks', '*.json')))
+
+def result_json(name, real_time=1.0, iterations=100, **extra):
+    result = {
+        'name': name,
+        'run_type': 'iteration',
+        'iterations': iterations,
+        'real_time': real_time,
+        'cpu_time': real_time,
+        'time_unit': 'us'
+    }
+    result.update(extra)
+    return result
+
+@pytest.fixture
+def write_results(tmp_path):
+    def write(results, filename='results.json'):
+        filepath = tmp_path / filename
+        filepath.write_text(json.dumps({'context': {}, 'benchmarks': results}))
+        return str(filepath)
+    return write
+
+@pytest.mark.parametrize('filepath', BENCHMARK_FILES)
+def test_bundled_params_are_ints(filepath):
+    info = BenchmarkInfo(filepath)
+    for benchmark_name in info.benchmark_names:
+        for param in info.params(benchmark_name):
+            assert info.param_type(benchmark_name, param) == ParamTypes.int
+            for dtype in info.dtypes(benchmark_name):
+                paramvals = info.paramvals(benchmark_name, dtype, param)
+                assert paramvals == sorted(paramvals)
+                assert info.minparamval(benchmark_name, dtype, param) == paramvals[0]
+
+def test_widening_is_consistent(write_results):
+    filepath = write_results([
+        result_json('b/f32/x:16'),
+        result_json('b/f64/x:8'),
+        result_json('b/f32/x:2.5'),
+        result_json('b/f32/x:fast'),
+    ])
+    bench = Benchmark(filepath, 'b')
+    assert bench.param_type('x') == ParamTypes.str
+    assert bench.collect_param_vals('x', 'f32') == ['16', '2.5', 'fast']
+    assert bench.collect_param_vals('x', 'f64') == ['8']
+
+    info = BenchmarkInfo(filepath)
+    assert info.param_type('b', 'x') == ParamTypes.str
+    assert info.paramvals('b', 'f32', 'x') == ['16', '2.5', 'fast']
+    assert info.paramvals('b', 'f64', 'x') == ['8']
+
+def test_filters_match_widened_params(write_results):
+    filepath = write_results([
+        result_json('b/f32/order:ascend', real_time=1.0),
+        result_json('b/f32/order:1', real_time=2.0),
+    ])
+    assert Benchmark(filepath, 'b', {'order': 1}).collect_real_times('f32') == [2.0]
+    assert Benchmark(filepath, 'b', {'order': 'ascend'}).collect_real_times('f32') == [1.0]
+
+def test_reordered_params_widen_cached_schema(write_results):
+    filepath = write_results([
+        result_json('b/f32/k:2/n:1'),
+        result_json('b/f32/[n]:1/k:4.5'),
+    ])
+    info = BenchmarkInfo(filepath)
+    assert info.param_type('b', 'k') == ParamTypes.float
+    assert info.paramvals('b', 'f32', 'k') == [2, 4.5]
+
+    bench = Benchmark(filepath, 'b')
+    assert bench.param_type('k') == ParamTypes.float
+    assert bench.collect_param_vals('k', 'f32') == [2.0, 4.5]
+
+def test_aggregate_rows_keep_param_types(write_results):
+    filepath = write_results([
+        result_json('b/f32/x:16'),
+        result_json('b/f32/x:16'),
+        result_json('b/f32/x:16_mean', run_type='aggregate', aggregate_name='mean'),
+        result_json('b/f32/x:16_stddev', run_name='b/f32/x:16', run_type='aggregate',
+                    aggregate_name='stddev'),
+    ])
+    info = BenchmarkInfo(filepath)
+    assert info.param_type('b', 'x') == ParamTypes.int
+    assert info.paramvals('b', 'f32', 'x') == [16]
+
+    bench = Benchmark(filepath, 'b', {'x': 16})
+    assert bench.collect_param_vals('x', 'f32') == [16, 16, 16, 16]
+    assert bench.collect_run_types('f32') == ['iteration', 'iteration', 'aggregate', 'aggregate']
+
+def test_query_columns_prefer_attributes(write_results, capfd):
+    filepath = write_results([
+        result_json('topkMemK/f32/[k]:2/iterations:1', iterations=500),
+        result_json('topkMemK/f32/[k]:4/iterations:1', iterations=600),
+    ])
+    main(['query', filepath, '-c', 'k,iterations,param.iterations,benchmark', '-f', 'csv'])
+    assert capfd.readouterr().out.splitlines() == [
+        'k,iterations,param.iterations,benchmark',
+        '2,500,1,topkMemK',
+        '4,600,1,topkMemK',
+    ]
+
+def test_query_streams_ndjson(write_results, capfd):
+    filepath = write_results([
+        result_json('fft2/c32/dim0:8/dim1:16', real_time=1.0),
+        result_json('fft2/c32/dim0:8/dim1:1', real_time=2.0),
+        result_json('fft2/f32/dim0:8/dim1:16', real_time=3.0),
+    ])
+    main(['query', filepath, '-b', 'fft2', '-d', 'c32', '-p', 'dim1:16', '-c', 'dim0,real_time'])
+    rows = [json.loads(line) for line in capfd.readouterr().out.splitlines()]
+    assert rows == [{'dim0': 8, 'real_time': 1.0}]
+
+def run_afbench(*args):
+    return subprocess.run([sys.executable, AFBENCH] + list(args), check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+def test_score_against_history_from_another_process(write_results, tmp_path):
+    # x:2.5 widens x to float while aggregating; the later file never sees it
+    history = write_results([
+        result_json('b/f32/x:16', real_time=1.0),
+        result_json('b/f32/x:2.5', real_time=5.0),
+        result_json('b/f32/[x]:16', real_time=3.0),
+    ], 'history_run.json')
+    new_run = write_results([result_json('b/f32/x:16', real_time=2.0)], 'new_run.json')
+    history_filepath = str(tmp_path / 'history.json')
+
+    run_afbench('aggregate', '-o', history_filepath, history)
+    scores = run_afbench('score', history_filepath, new_run).stdout.splitlines()
+    assert len(scores) == 1
+    score = json.loads(scores[0])
+    assert score['key'] == 'b/f32/x:16'
+    assert score['count'] == 2
+    assert score['mean'] == pytest.approx(2000.0)
+    assert score['zscore'] == pytest.approx(0.0)
+    assert score['percentile'] == pytest.approx(0.5)
+
+def test_aggregate_skips_files_already_in_history(write_results, tmp_path):
+    filepath = write_results([result_json('b/f32/x:16')])
+    history_filepath = str(tmp_path / 'history.json')
+    run_afbench('aggregate', '-o', history_filepath, filepath)
+    rerun = run_afbench('aggregate', '-o', history_filepath, filepath)
+    assert 'skipping' in rerun.stderr
+    assert Aggregator.load(history_filepath).sketch('b/f32/x:16').stats.count == 1
+
+def test_aggregate_rejects_other_compression(write_results, tmp_path):
+    filepath = write_results([result_json('b/f32/x:16')])
+    history_filepath = str(tmp_path / 'history.json')
+    run_afbench('aggregate', '-o', history_filepath, '--compression', '50', filepath)
+    with pytest.raises(subprocess.CalledProcessError):
+        run_afbench('aggregate', '-o', history_filepath, '--compression', '200')
+    run_afbench('aggregate', '-o', history_filepath, '--compression', '50')
+    assert Aggregator.load(history_filepath).compression == 50
+
+def test_aggregate_skips_aggregate_results(write_results):
+    aggregator = Aggregator()
+    aggregator.add_file(write_results([
+        result_json('b/f32/x:16', real_time=1.0),
+        result_json('b/f32/x:16_mean', real_time=1.0, run_type='aggregate',
+                    aggregate_name='mean'),
+    ]))
+    assert aggregator.keys == ['b/f32/x:16']
+    assert aggregator.sketch('b/f32/x:16').stats.count == 1
+
+def random_vals(count, seed=0):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(0, 1) for _ in range(count)]
+
+def test_running_stats_merge_equals_sequential():
+    vals = random_vals(10000)
+    sequential = RunningStats()
+    for val in vals:
+        sequential.add(val)
+    merged = RunningStats()
+    for part in (vals[:1], vals[1:3000], vals[3000:]):
+        stats = RunningStats()
+        for val in part:
+            stats.add(val)
+        merged.merge(stats)
+    merged.merge(RunningStats())
+
+    assert merged.count == sequential.count
+    assert merged.mean == pytest.approx(sequential.mean)
+    assert merged.variance == pytest.approx(sequential.variance)
+    assert merged.min == sequential.min
+    assert merged.max == sequential.max
+
+def test_running_stats_empty_and_single():
+    stats = RunningStats()
+    assert (stats.count, stats.mean, stats.variance, stats.min, stats.max) == (0, None, None, None, None)
+    stats.add(3.0)
+    assert (stats.count, stats.mean, stats.variance, stats.min, stats.max) == (1, 3.0, None, 3.0, 3.0)
+
+def test_running_stats_json_round_trip():
+    stats = RunningStats()
+    for val in random_vals(100):
+        stats.add(val)
+    loaded = RunningStats.from_json(json.loads(json.dumps(stats.to_json())))
+    assert loaded.to_json() == stats.to_json()
+
+def test_tdigest_merge_equals_sequential():
+    vals = random_vals(20000)
+    sequential = TDigest()
+    for val in vals:
+        sequential.add(val)
+    merged = TDigest()
+    for part in (vals[:7000], vals[7000:]):
+        digest = TDigest()
+        for val in part:
+            digest.add(val)
+        merged.merge(digest)
+
+    sorted_vals = sorted(vals)
+    assert merged.count == sequential.count == len(vals)
+    for q in (0.01, 0.5, 0.95, 0.99):
+        exact = sorted_vals[int(q * len(vals))]
+        assert merged.quantile(q) == pytest.approx(exact, rel=0.05)
+        assert sequential.quantile(q) == pytest.approx(exact, rel=0.05)
+        assert merged.cdf(exact) == pytest.approx(q, abs=0.01)
+    assert merged.quantile(0.0) == sorted_vals[0]
+    assert merged.quantile(1.0) == sorted_vals[-1]
+
+def test_tdigest_json_round_trip():
+    digest = TDigest(50)
+    for val in random_vals(5000):
+        digest.add(val)
+    loaded = TDigest.from_json(json.loads(json.dumps(digest.to_json())))
+    assert loaded.compression == 50
+    assert loaded.count == digest.count
+    for q in (0.0, 0.25, 0.5, 0.99, 1.0):
+        assert loaded.quantile(q) == digest.quantile(q)
+
+def test_tdigest_empty_and_single():
+    digest = TDigest()
+    assert digest.quantile(0.5) is None
+    assert digest.cdf(1.0) is None
+    digest.merge(TDigest())
+    assert digest.quantile(0.5) is None
+
+    digest.add(7.0)
+    assert digest.quantile(0.0) == digest.quantile(0.5) == digest.quantile(1.0) == 7.0
+    assert digest.cdf(6.0) == 0.0
+    assert digest.cdf(7.0) == 1.0
+
+@pytest.fixture
+def attached_table():
+    # Round trips the table through shared memory, the way viz.py's workers
+    # get it
+    if shared_memory is None:
+        pytest.skip('shared memory needs Python 3.8+')
+    segments = []
+    tables = []
+    def attach(filepath):
+        table = ResultTable.from_file(filepath)
+        shm = table.to_shared_memory()
+        table.close()
+        segments.append(shm)
+        tables.append(ResultTable.attach(shm.name))
+        return tables[-1]
+    yield attach
+    for table in tables:
+        table.close()
+    for shm in segments:
+        shm.close()
+        shm.unlink()
+
+def assert_table_matches_benchmarks(table, filepath):
+    info = BenchmarkInfo(filepath)
+    assert table.benchmark_names == info.benchmark_names
+    for benchmark_name in info.benchmark_names:
+        bench = Benchmark(filepath, benchmark_name)
+        assert table.params(benchmark_name) == info.params(benchmark_name)
+        assert table.dtypes(benchmark_name) == info.dtypes(benchmark_name)
+        for dtype in info.dtypes(benchmark_name):
+            for param in info.params(benchmark_name):
+                assert (table.paramvals(benchmark_name, dtype, param) ==
+                        info.paramvals(benchmark_name, dtype, param))
+        for dtype in bench.avail_dtypes:
+            rows = table.select(benchmark_name, dtype)
+            assert table.collect(Attributes.run_type, rows) == bench.collect_run_types(dtype)
+            assert table.collect(Attributes.iterations, rows) == bench.collect_iterations(dtype)
+            assert table.collect(Attributes.real_time, rows) == bench.collect_real_times(dtype)
+            assert table.collect(Attributes.cpu_time, rows) == bench.collect_cpu_times(dtype)
+            assert table.collect(Attributes.time_unit, rows) == bench.collect_time_units(dtype)
+            for param in bench.avail_params:
+                assert table.param_type(benchmark_name, param) == bench.param_type(param)
+                assert table.collect_param_vals(param, rows) == bench.collect_param_vals(param, dtype)
+
+            for param in bench.avail_params:
+                for paramval in info.paramvals(benchmark_name, dtype, param)[:4]:
+                    filtered = Benchmark(filepath, benchmark_name, {param: paramval})
+                    rows = table.select(benchmark_name, dtype, {param: paramval})
+                    assert rows, (benchmark_name, dtype, param, paramval)
+                    assert (table.collect(Attributes.real_time, rows) ==
+                            filtered.collect_real_times(dtype))
+                    for other_param in bench.avail_params:
+                        assert (table.collect_param_vals(other_param, rows) ==
+                                filtered.collect_param_vals(other_param, dtype))
+
+@pytest.mark.parametrize('filepath', BENCHMARK_FILES)
+def test_result_table_matches_benchmark(attached_table, filepath):
+    assert_table_matches_benchmarks(attached_table(filepath), filepath)
+
+def test_result_table_matches_benchmark_mixed_types(attached_table, write_results):
+    filepath = write_results([
+        # Same param name, different types in different benchmarks
+        result_json('a/f32/k:fast'),
+        result_json('b/f32/k:5'),
+        result_json('a/f32/k:slow'),
+        result_json('b/f32/k:10'),
+        # Widened through float to str, and a filter of 1 on a str param
+        result_json('c/f32/x:16/order:ascend'),
+        result_json('c/f64/x:8/order:1'),
+        result_json('c/f32/x:2.5/order:1'),
+        result_json('c/f32/x:fast/order:descend'),
+        # A param named like a result attribute
+        result_json('topkMemK/f32/[k]:2/iterations:1', iterations=500),
+        result_json('topkMemK/f32/[k]:4/iterations:1', iterations=600),
+        result_json('topkMemK/f32/[k]:8/iterations:1', iterations=700),
+        # Reordered params
+        result_json('d/f32/k:2/n:1'),
+        result_json('d/f32/[n]:1/k:4.5'),
+        # Repetitions with aggregates
+        result_json('e/f32/x:16'),
+        result_json('e/f32/x:16_mean', run_type='aggregate', aggregate_name='mean'),
+    ])
+    table = attached_table(filepath)
+    assert_table_matches_benchmarks(table, filepath)
+
+    assert table.collect_param_vals('k', table.select('b', 'f32')) == [5, 10]
+    assert table.collect(Attributes.iterations, table.select('topkMemK')) == [500, 600, 700]
+    assert table.collect_param_vals('iterations', table.select('topkMemK')) == [1, 1, 1]
+    assert len(table.select('c', None, {'order': 1})) == 2
+    assert table.select('c', 'f32', {'x': 16}) == table.select('c', 'f32', {'x': '16'})
+    assert table.select('nope') == []
+    assert table.select('a', None, {'nope': 1}) == []
+
+def test_ints_outside_64_bits_widen_to_float(write_results, attached_table):
+    filepath = write_results([
+        result_json('b/f32/x:16'),
+        result_json('b/f32/x:99999999999999999999'),
+        result_json('c/f32/x:99999999999999999999'),
+    ])
+    bench = Benchmark(filepath, 'b')
+    assert bench.param_type('x') == ParamTypes.float
+    assert bench.collect_param_vals('x', 'f32') == [16.0, 1e20]
+    assert BenchmarkInfo(filepath).param_type('c', 'x') == ParamTypes.float
+    assert_table_matches_benchmarks(attached_table(filepath), filepath)
+
+@pytest.mark.parametrize('val_str', ['1_000', ' 16', '16 ', 'nan', 'inf', '-Infinity', '0x10', '1e'])
+def test_only_numeric_literals_are_numbers(write_results, val_str):
+    filepath = write_results([result_json('b/f32/x:{}'.format(val_str))])
+    assert Benchmark(filepath, 'b').param_type('x') == ParamTypes.str
+
+@pytest.mark.parametrize('val_str,param_type', [
+    ('-16', ParamTypes.int), ('+16', ParamTypes.int), ('1.', ParamTypes.float),
+    ('.5', ParamTypes.float), ('2.5e-3', ParamTypes.float), ('1E6', ParamTypes.float),
+])
+def test_numeric_literals(write_results, val_str, param_type):
+    filepath = write_results([result_json('b/f32/x:{}'.format(val_str))])
+    assert Benchmark(filepath, 'b').param_type('x') == param_type
+
+def test_nan_params_match_filters(write_results, capfd):
+    filepath = write_results([
+        result_json('b/f32/norm:nan', real_time=1.0),
+        result_json('b/f32/norm:l2', real_time=2.0),
+    ])
+    assert Benchmark(filepath, 'b', {'norm': float('nan')}).collect_real_times('f32') == [1.0]
+    assert Benchmark(filepath, 'b', {'norm': 'nan'}).collect_real_times('f32') == [1.0]
+    main(['query', filepath, '-p', 'norm:nan', '-c', 'real_time', '-f', 'csv'])
+    assert capfd.readouterr().out.splitlines() == ['real_time', '1.0']
+
+def test_query_rejects_unknown_columns(write_results, capfd):
+    filepath = write_results([result_json('b/f32/x:16/y:1'), result_json('c/f32/z:1')])
+    with pytest.raises(SystemExit) as exc_info:
+        main(['query', filepath, '-c', 'x,real_tme,param.nope'])
+    assert 'real_tme, param.nope' in str(exc_info.value)
+    assert capfd.readouterr().out == ''
+
+    # Later results without a column output it as null
+    main(['query', filepath, '-c', 'x,param.y,real_time'])
+    rows = [json.loads(line) for line in capfd.readouterr().out.splitlines()]
+    assert rows == [{'x': 16, 'param.y': 1, 'real_time': 1.0},
+                    {'x': None, 'param.y': None, 'real_time': 1.0}]
+
+def test_result_table_selects_run_type(write_results, attached_table):
+    filepath = write_results([
+        result_json('b/f32/x:16', real_time=1.0),
+        result_json('b/f32/x:16', real_time=3.0),
+        result_json('b/f32/x:16_mean', real_time=2.0, run_type='aggregate', aggregate_name='mean'),
+        result_json('b/f32/x:16_stddev', real_time=1.4, run_type='aggregate',
+                    aggregate_name='stddev'),
+        result_json('b/f32/x:32', real_time=4.0),
+    ])
+    table = attached_table(filepath)
+    rows = table.select('b', 'f32', {'x': 16}, RunTypes.iteration)
+    assert table.collect(Attributes.real_time, rows) == [1.0, 3.0]
+    rows = table.select('b', 'f32', run_type=RunTypes.aggregate)
+    assert table.collect(Attributes.real_time, rows) == [2.0, 1.4]
+    assert len(table.select('b', 'f32')) == 5
+    assert table.paramvals('b', 'f32', 'x') == [16, 32]
@@ -0,0 +1,143 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+# The pinned dash==0.26.5 doesn't import on Python 3.10+ (it uses
+# collections.MutableMapping), which fails with AttributeError, not ImportError
+try:
+    import dash
+    import werkzeug
+except Exception as e:
+    pytest.skip('viz.py needs a working dash and werkzeug: {!r}'.format(e),
+                allow_module_level=True)
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='--workers needs fork()')
+
+VIZ = os.path.join(os.path.dirname(__file__), 'viz.py')
+FFT_JSON = os.path.join(os.path.dirname(__file__), 'benchmarks', 'fft.json')
+
+def free_port(family, host):
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def shared_memory_segments():
+    if not os.path.isdir('/dev/shm'):
+        return set()
+    return set(os.listdir('/dev/shm'))
+
+def get(url, timeout=20):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                return response.status, response.read()
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+def is_alive(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            return stat_file.read().split()[2] != 'Z'
+    except FileNotFoundError:
+        return False
+
+def wait_until(condition, timeout=20):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.2)
+    return True
+
+class Viz:
+    def __init__(self, family=socket.AF_INET, host='127.0.0.1', workers=2):
+        self.port = free_port(family, host)
+        url_host = '[{}]'.format(host) if family == socket.AF_INET6 else host
+        self.url = 'http://{}:{}'.format(url_host, self.port)
+        self.segments_before = shared_memory_segments()
+        self.process = subprocess.Popen(
+            [sys.executable, VIZ, FFT_JSON, '--workers', str(workers),
+             '--host', host, '--port', str(self.port)],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        get(self.url + '/')
+
+    def workers(self):
+        # Children other than multiprocessing's resource tracker
+        pid = self.process.pid
+        with open('/proc/{}/task/{}/children'.format(pid, pid)) as children_file:
+            children = [int(child) for child in children_file.read().split()]
+        workers = []
+        for child in children:
+            with open('/proc/{}/cmdline'.format(child), 'rb') as cmdline_file:
+                if b'resource_tracker' not in cmdline_file.read():
+                    workers.append(child)
+        return workers
+
+    def stop(self, sig=signal.SIGINT):
+        self.process.send_signal(sig)
+        return self.process.communicate(timeout=20)[0].decode()
+
+    def leaked_segments(self):
+        return shared_memory_segments() - self.segments_before
+
+@pytest.mark.parametrize('family,host', [
+    (socket.AF_INET, '127.0.0.1'),
+    pytest.param(socket.AF_INET6, '::1', marks=pytest.mark.skipif(
+        not socket.has_ipv6, reason='no IPv6 support')),
+])
+def test_workers_serve_shared_table(family, host):
+    try:
+        viz = Viz(family, host)
+    except OSError:
+        pytest.skip('cannot bind {}'.format(host))
+    try:
+        for path in ['/', '/_dash-layout', '/_dash-layout', '/_dash-dependencies']:
+            status, body = get(viz.url + path)
+            assert status == 200
+            assert body
+        assert len(viz.leaked_segments()) == 1
+    finally:
+        output = viz.stop()
+
+    assert viz.process.returncode == 0, output
+    assert not viz.leaked_segments()
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/task'), reason='needs /proc')
+def test_sigterm_stops_workers_and_frees_memory():
+    viz = Viz()
+    workers = viz.workers()
+    assert len(workers) == 2
+    output = viz.stop(signal.SIGTERM)
+    assert viz.process.returncode == 0, output
+    assert not any(is_alive(worker) for worker in workers)
+    assert not viz.leaked_segments()
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/task'), reason='needs /proc')
+def test_dead_worker_shuts_server_down_with_error():
+    viz = Viz()
+    workers = viz.workers()
+    os.kill(workers[0], signal.SIGKILL)
+    output = viz.process.communicate(timeout=20)[0].decode()
+    assert viz.process.returncode == 1
+    assert 'exited with signal {}'.format(signal.SIGKILL) in output
+    assert not any(is_alive(worker) for worker in workers)
+    assert not viz.leaked_segments()
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/task'), reason='needs /proc')
+def test_workers_exit_with_parent():
+    viz = Viz()
+    workers = viz.workers()
+    viz.process.kill()
+    viz.process.communicate(timeout=20)
+    assert wait_until(lambda: not any(is_alive(worker) for worker in workers))
+    # The resource tracker cleans up after the last process holding it exits
+    assert wait_until(lambda: not viz.leaked_segments())
@@ -1,43 +1,57 @@
-from afbench import Benchmark, BenchmarkInfo
+from afbench import Attributes, ResultTable, RunTypes
 
 from dash.dependencies import Input, Output, State, Event
 from dash.exceptions import CantHaveMultipleOutputs
+from werkzeug.serving import make_server
+import argparse
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+import os
 import plotly.graph_objs as go
+import signal
+import socket
 import sys
+import threading
+import traceback
 
 app = dash.Dash('ArrayFire Benchmarks POC')
 app.config['suppress_callback_exceptions'] = True
 
-if len(sys.argv) > 2:
-    print('Usage: ./viz.py <benchmark_filepath>')
-    exit(-1)
-
-# Parse benchmark JSON file
-__benchmark_filepath = sys.argv[1]
-__bench_info = BenchmarkInfo(__benchmark_filepath)
+__arg_parser = argparse.ArgumentParser(prog='viz.py')
+__arg_parser.add_argument('benchmark_filepath')
+__arg_parser.add_argument('--host', default='127.0.0.1')
+__arg_parser.add_argument('--port', type=int, default=8050)
+__arg_parser.add_argument('--workers', type=int, default=1,
+                          help='number of server processes sharing the port '
+                          'and a single in-memory copy of the results')
+__args = __arg_parser.parse_args()
+
+# Parse benchmark JSON file into a columnar table. Both the controls and the
+# graph are built from it, so with --workers the shared segment is the only
+# copy of the data
+__benchmark_filepath = __args.benchmark_filepath
+__results = ResultTable.from_file(__benchmark_filepath)
 
 ##################
 # Initialization
 ##################
 
-__init_bench = __bench_info.benchmark_names[0]
-__init_dtype = __bench_info.dtypes(__init_bench)[0]
-__init_indep_var = __bench_info.params(__init_bench)[0]
+__init_bench = __results.benchmark_names[0]
+__init_dtype = __results.dtypes(__init_bench)[0]
+__init_indep_var = __results.params(__init_bench)[0]
 __bench_select_opts = [{'label': benchname, 'value': benchname}
-                    for benchname in __bench_info.benchmark_names]
+                    for benchname in __results.benchmark_names]
 __dtype_select_opts = [{'label': dtype, 'value': dtype}
-                     for dtype in __bench_info.dtypes(__init_bench)]
+                     for dtype in __results.dtypes(__init_bench)]
 __sliders = []
 __paramselect_opts = []
-for param in __bench_info.params(__init_bench):
+for param in __results.params(__init_bench):
     is_disabled = False
     if param == __init_indep_var:
         is_disabled = True
 
-    paramvals = __bench_info.paramvals(__init_bench, __init_dtype, param)
+    paramvals = __results.paramvals(__init_bench, __init_dtype, param)
     __sliders.append(
         html.Div(
             children=[
@@ -245,18 +259,14 @@ def update_graph(curr_bench, curr_dtype, indep_var, sliders_container):
         # label text, which should be the same as the param name
         param = slider_div['props']['children'][0]['props']['children']
         slider_val = slider_div['props']['children'][1]['props']['value']
-        paramval = __bench_info.paramvals(curr_bench, curr_dtype, param)[slider_val]
+        paramval = __results.paramvals(curr_bench, curr_dtype, param)[slider_val]
         if param != indep_var:
             param_filters[param] = paramval
 
-    benchmark = Benchmark(
-        filepath=__benchmark_filepath,
-        name=curr_bench,
-        filters=param_filters
-    )
-
-    indepvar_vals = benchmark.collect_param_vals(indep_var, curr_dtype)
-    real_times = benchmark.collect_real_times(curr_dtype)
+    # Aggregates of repeated runs (mean, median, stddev) aren't timings
+    rows = __results.select(curr_bench, curr_dtype, param_filters, RunTypes.iteration)
+    indepvar_vals = __results.collect_param_vals(indep_var, rows)
+    real_times = __results.collect(Attributes.real_time, rows)
 
     return {
         'data': [{
@@ -276,11 +286,11 @@ def update_graph(curr_bench, curr_dtype, indep_var, sliders_container):
 
 @app.callback(Output('radio_paramselect', 'options'), [Input('dropdown_benchmarks', 'value')])
 def update_radio_paramselect_options(dropdown_value):
-    return [{'value': param} for param in __bench_info.params(dropdown_value)]
+    return [{'value': param} for param in __results.params(dropdown_value)]
 
 @app.callback(Output('dropdown_dtypes', 'options'), [Input('dropdown_benchmarks', 'value')])
 def update_dropdown_dtypes_options(dropdown_value):
-    return [{'label': dtype, 'value': dtype} for dtype in __bench_info.dtypes(dropdown_value)]
+    return [{'label': dtype, 'value': dtype} for dtype in __results.dtypes(dropdown_value)]
 
 @app.callback(Output('dropdown_dtypes', 'value'), [Input('dropdown_dtypes', 'options')])
 def update_dropdown_dtypes_value(dropdown_options):
@@ -288,7 +298,7 @@ def update_dropdown_dtypes_value(dropdown_options):
 
 @app.callback(Output('radio_paramselect', 'value'), [Input('dropdown_benchmarks', 'value')])
 def update_radio_paramselect_value(dropdown_value):
-    return __bench_info.params(dropdown_value)[0]
+    return __results.params(dropdown_value)[0]
 
 # There is no fixed set of sliders, so register the callbacks in runtime
 def update_slider_disabled(radio_value, slider_id):
@@ -326,14 +336,14 @@ def set_sliders_callback(sliders_container, radio_value):
               [Input('dropdown_benchmarks', 'value'), Input('dropdown_dtypes', 'value')])
 def change_sliders(curr_bench, curr_dtype):
     slider_divs = []
-    indep_var = __bench_info.params(curr_bench)[0]
+    indep_var = __results.params(curr_bench)[0]
     graph_inputs = []
-    for param in __bench_info.params(curr_bench):
+    for param in __results.params(curr_bench):
         is_disabled = False
         if param == indep_var:
             is_disabled = True
 
-        paramvals = __bench_info.paramvals(curr_bench, curr_dtype, param)
+        paramvals = __results.paramvals(curr_bench, curr_dtype, param)
         slider_div = html.Div(
             children=[
                 html.Label(param),
@@ -360,5 +370,118 @@ def change_sliders(curr_bench, curr_dtype):
 
 app.css.append_css({'external_url': 'https://codepen.io/chriddyp/pen/bWLwgP.css'})
 
+###############
+# Serving
+###############
+
+# SIGTERM (kill, systemctl stop, docker stop) takes the same shutdown path as
+# Ctrl-C
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def _exit_with_parent(parent_alive_fd):
+    # Only the parent holds the pipe's write end, so the read returns once
+    # the parent is gone, however it died
+    os.read(parent_alive_fd, 1)
+    os._exit(0)
+
+def _run_worker(shm_name, host, port, listener, parent_alive_fd):
+    global __results
+
+    status = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        threading.Thread(target=_exit_with_parent, args=(parent_alive_fd,),
+                         daemon=True).start()
+        __results = ResultTable.attach(shm_name)
+        server = make_server(host, port, app.server, fd=listener.fileno())
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stderr.flush()
+        os._exit(status)
+
+def _exit_status(status):
+    if os.WIFSIGNALED(status):
+        return 'signal {}'.format(os.WTERMSIG(status))
+    return 'status {}'.format(os.WEXITSTATUS(status))
+
+# Pre-forks several server processes that accept connections on the same
+# listening socket. The results are moved into shared memory first, so every
+# worker maps the same pages instead of holding its own copy. If a worker
+# dies, the whole server shuts down with an error rather than carrying on
+# with fewer workers
+def run_workers(num_workers, host, port):
+    global __results
+
+    if not hasattr(os, 'fork'):
+        print('--workers needs a platform with fork()')
+        exit(-1)
+
+    shm = __results.to_shared_memory()
+    __results.close()
+    __results = None
+
+    # Resolve the host once so the listener and werkzeug agree on the address
+    # family, whether it's IPv4 or IPv6
+    family, _, _, _, sockaddr = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    host = sockaddr[0]
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(sockaddr)
+    listener.listen(128)
+
+    parent_alive_fd, parent_alive_write_fd = os.pipe()
+    signal.signal(signal.SIGTERM, _interrupt)
+    workers = set()
+    failed = False
+    try:
+        for _ in range(num_workers):
+            pid = os.fork()
+            if pid == 0:
+                os.close(parent_alive_write_fd)
+                _run_worker(shm.name, host, port, listener, parent_alive_fd)
+            workers.add(pid)
+
+        url_host = '[{}]'.format(host) if family == socket.AF_INET6 else host
+        print('Serving on http://{}:{}/ with {} workers'.format(url_host, port, num_workers))
+        sys.stdout.flush()
+
+        # Workers only exit on their own if something went wrong. Other
+        # children (e.g. multiprocessing's resource tracker) are not our concern
+        pid, status = os.wait()
+        while pid not in workers:
+            pid, status = os.wait()
+        workers.discard(pid)
+        print('Worker {} exited with {}, shutting down'.format(pid, _exit_status(status)),
+              file=sys.stderr)
+        failed = True
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        os.close(parent_alive_write_fd)
+        os.close(parent_alive_fd)
+        listener.close()
+        shm.close()
+        shm.unlink()
+
+    if failed:
+        exit(1)
+
 if __name__ == '__main__':
-    app.run_server()
+    if __args.workers > 1:
+        run_workers(__args.workers, __args.host, __args.port)
+    else:
+        app.run_server(host=__args.host, port=__args.port)